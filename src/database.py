@@ -1,16 +1,43 @@
 import aiosqlite
+import itertools
 import json
 import logging
+import orjson
+from collections import Counter
+from contextlib import nullcontext
+from functools import lru_cache
 from .models import Event
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, Optional
 
 DATABASE_PATH = "/app/data/aggregator.db"
 
+def connect() -> aiosqlite.Connection:
+    """
+    Membuka koneksi ke DATABASE_PATH.
+    uri=True agar path berbentuk URI (mis. 'file:x?mode=memory&cache=shared')
+    juga didukung; path file biasa tetap diperlakukan seperti sebelumnya.
+    """
+    return aiosqlite.connect(DATABASE_PATH, uri=True)
+
+# PRAGMA yang berlaku per koneksi, jadi harus dipasang di setiap koneksi baru
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 268435456",   # 256 MiB
+    "PRAGMA cache_size = -65536",     # 64 MiB
+    "PRAGMA wal_autocheckpoint = 1000",
+)
+
+async def configure_connection(db: aiosqlite.Connection):
+    """Memasang PRAGMA performa pada koneksi agar index & tabel temp tetap di RAM."""
+    for pragma in CONNECTION_PRAGMAS:
+        await db.execute(pragma)
+
 async def init_db():
     """Inisialisasi database dan tabel."""
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with connect() as db:
         await db.execute("PRAGMA journal_mode = WAL")
-        await db.execute("PRAGMA synchronous = NORMAL")
+        await configure_connection(db)
         
         await db.execute("""
             CREATE TABLE IF NOT EXISTS processed_events (
@@ -22,85 +49,153 @@ async def init_db():
                 PRIMARY KEY (topic, event_id)
             )
         """)
+        # Index agar 'WHERE topic = ? ORDER BY timestamp' tidak perlu sort terpisah
+        await db.execute(
+            "CREATE INDEX IF NOT EXISTS idx_events_topic_ts ON processed_events(topic, timestamp)"
+        )
         await db.commit()
         logging.info(f"Database initialized at {DATABASE_PATH}")
 
-async def batch_mark_events_processed(db: aiosqlite.Connection, events: List[Event]) -> int:
+# Ukuran chunk INSERT multi-row (baris per statement). Batch dipecah hanya ke
+# ukuran-ukuran tetap ini, sehingga SQL yang muncul cuma sebanyak ukurannya dan
+# statement yang sudah di-prepare selalu diambil dari statement cache koneksi
+# (panjang batch dari consumer bervariasi mengikuti qsize()).
+INSERT_CHUNK_SIZES = (256, 64, 16, 4, 1)
+
+@lru_cache(maxsize=len(INSERT_CHUNK_SIZES))
+def _insert_returning_sql(n_rows: int) -> str:
+    """Membuat (dan meng-cache) SQL INSERT OR IGNORE multi-row dengan RETURNING."""
+    values = ",".join(["(?, ?, ?, ?, ?)"] * n_rows)
+    return (
+        "INSERT OR IGNORE INTO processed_events "
+        "(topic, event_id, timestamp, source, payload_json) "
+        f"VALUES {values} RETURNING topic"
+    )
+
+def _split_chunks(rows: List[tuple]) -> Iterator[List[tuple]]:
+    """Memecah baris secara greedy menjadi chunk berukuran dari INSERT_CHUNK_SIZES."""
+    start = 0
+    for size in INSERT_CHUNK_SIZES:
+        while len(rows) - start >= size:
+            yield rows[start : start + size]
+            start += size
+
+def dumps_json(obj: Any) -> bytes:
+    """
+    Encode ke JSON dengan orjson; fallback ke json stdlib untuk nilai yang
+    tidak didukung orjson (mis. integer di luar 64-bit).
+    """
+    try:
+        return orjson.dumps(obj)
+    except orjson.JSONEncodeError:
+        return json.dumps(obj).encode()
+
+@lru_cache(maxsize=256)
+def _encode_payload_items(items: tuple) -> str:
+    """Serialisasi payload (tuple berisi (key, type, value)) dengan cache untuk payload berulang."""
+    return dumps_json({key: value for key, _, value in items}).decode()
+
+def encode_payload(payload: Dict[str, Any]) -> str:
+    """
+    Mengubah payload menjadi string JSON.
+    Payload dengan nilai hashable di-memoize, sisanya langsung di-encode.
+    """
+    # Tipe ikut jadi key agar 1, 1.0, dan True tidak berbagi entri cache
+    key = tuple((k, type(v), v) for k, v in payload.items())
+    # Float tidak di-memoize: 0.0 dan -0.0 sama (hash pun sama) tapi di-encode berbeda
+    if any(value_type is float for _, value_type, _ in key):
+        return dumps_json(payload).decode()
+    try:
+        hash(key)
+    except TypeError:
+        # Nilai tidak hashable (mis. nested dict/list): encode tanpa cache
+        return dumps_json(payload).decode()
+    return _encode_payload_items(key)
+
+async def batch_mark_events_processed(cursor: aiosqlite.Cursor, events: List[Event]) -> Dict[str, int]:
     """
-    Mencoba menyimpan batch event ke DB dalam satu transaksi.
+    Mencoba menyimpan batch event ke DB di dalam transaksi yang sedang terbuka.
     Menggunakan 'INSERT OR IGNORE' untuk idempotency atomik.
+    Commit menjadi tanggung jawab pemanggil (consumer melakukan group commit).
     
     Args:
-        db: Koneksi aiosqlite yang sudah ada.
+        cursor: Cursor aiosqlite milik consumer, dipakai ulang lintas batch.
         events: Daftar event yang akan diproses.
         
     Return:
-        int: Jumlah event baru (unik) yang berhasil disimpan.
+        Dict[str, int]: Jumlah event baru (unik) yang berhasil disimpan, per topic.
     """
-    # Siapkan data untuk executemany
+    # Siapkan data (satu tuple per baris) untuk statement INSERT
     data_to_insert = [
         (
             event.topic,
             event.event_id,
             event.timestamp.isoformat(),
             event.source,
-            json.dumps(event.payload)
+            encode_payload(event.payload)
         ) for event in events
     ]
     
     if not data_to_insert:
-        return 0
+        return {}
 
     try:
-        # Simpan total changes sebelumnya
-        initial_changes = db.total_changes
+        new_per_topic = Counter()
+        # Satu statement multi-row per chunk; RETURNING hanya menghasilkan
+        # baris yang benar-benar di-INSERT (duplikat di-IGNORE tidak ikut)
+        for chunk in _split_chunks(data_to_insert):
+            flat_params = tuple(itertools.chain.from_iterable(chunk))
+            await cursor.execute(_insert_returning_sql(len(chunk)), flat_params)
+            for (topic,) in await cursor.fetchall():
+                new_per_topic[topic] += 1
         
-        await db.executemany(
-            """
-            INSERT OR IGNORE INTO processed_events 
-                (topic, event_id, timestamp, source, payload_json)
-            VALUES (?, ?, ?, ?, ?)
-            """,
-            data_to_insert
-        )
-        await db.commit()
-        
-        # 'total_changes' akan berisi jumlah baris yang *benar-benar* di-INSERT
-        # Kita hitung selisihnya untuk mendapatkan jumlah baris yang baru ditambahkan
-        newly_inserted_count = db.total_changes - initial_changes
-        return newly_inserted_count
+        return new_per_topic
         
     except aiosqlite.Error as e:
         logging.error(f"Database error while batch marking events: {e}", exc_info=True)
-        return 0 # Asumsikan gagal memproses
+        return {} # Asumsikan gagal memproses
 
-async def get_events_by_topic(topic: str) -> List[Dict[str, Any]]:
-    """Mengambil semua event unik yang telah diproses untuk sebuah topic."""
+async def get_events_by_topic(
+    topic: str, db: Optional[aiosqlite.Connection] = None
+) -> Optional[List[Dict[str, Any]]]:
+    """
+    Mengambil semua event unik yang telah diproses untuk sebuah topic.
+    Jika 'db' diberikan, koneksi tersebut dipakai ulang (tidak ditutup);
+    jika tidak, dibuka koneksi baru khusus untuk query ini.
+    Mengembalikan None jika query gagal, agar tidak tertukar dengan topic kosong.
+    """
     events = []
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with (nullcontext(db) if db is not None else connect()) as db:
             async with db.execute(
-                "SELECT * FROM processed_events WHERE topic = ? ORDER BY timestamp", 
+                """
+                SELECT topic, event_id, timestamp, source, payload_json
+                FROM processed_events WHERE topic = ? ORDER BY timestamp
+                """,
                 (topic,)
             ) as cursor:
-                async for row in cursor:
+                async for row_topic, event_id, timestamp, source, payload_json in cursor:
                     events.append({
-                        "topic": row["topic"],
-                        "event_id": row["event_id"],
-                        "timestamp": row["timestamp"],
-                        "source": row["source"],
-                        "payload": json.loads(row["payload_json"])
+                        "topic": row_topic,
+                        "event_id": event_id,
+                        # Disimpan via isoformat() ("+00:00"); UTC ditulis "Z" seperti
+                        # serialisasi Pydantic pada format response /events sebelumnya
+                        "timestamp": timestamp[:-6] + "Z" if timestamp.endswith("+00:00") else timestamp,
+                        "source": source,
+                        # json stdlib, bukan orjson: orjson.loads diam-diam mengubah
+                        # integer > 64-bit menjadi float (kehilangan presisi)
+                        "payload": json.loads(payload_json)
                     })
     except aiosqlite.Error as e:
         logging.error(f"Database error while getting events: {e}", exc_info=True)
+        return None
     return events
 
 async def get_topic_stats() -> Dict[str, int]:
     """Menghitung jumlah event unik per topic."""
     stats = {}
     try:
-        async with aiosqlite.connect(DATABASE_PATH) as db:
+        async with connect() as db:
             async with db.execute(
                 "SELECT topic, COUNT(*) as count FROM processed_events GROUP BY topic"
             ) as cursor:
@@ -1,38 +1,108 @@
 # main.py
 
 import asyncio
+import email.message
+import hashlib
+from collections import Counter
 import logging
 import uvicorn
 import time
 import aiosqlite
-from fastapi import FastAPI, Request, HTTPException, Query
-from pydantic import ValidationError
+from fastapi import FastAPI, Request, Response, HTTPException, Query
+from fastapi.exceptions import RequestValidationError
+from pydantic import TypeAdapter, ValidationError
 from typing import List, Union
 
 from . import database
-from .models import Event
+from .models import Event, EventListAdapter
 from .stats import StatsTracker
 
 # Konfigurasi logging dasar
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # --- Konfigurasi Consumer ---
-CONSUMER_BATCH_SIZE = 100
-CONSUMER_WORKERS = 2
+CONSUMER_BATCH_SIZE = 500
+# SQLite (WAL) hanya mengizinkan satu writer; satu consumer dengan batch besar
+# lebih cepat daripada beberapa writer yang saling menunggu lock
+CONSUMER_WORKERS = 1
+# Group commit: commit setelah sekian baris atau sekian detik sejak transaksi dibuka
+GROUP_COMMIT_ROWS = 500
+GROUP_COMMIT_INTERVAL = 0.05
+# Batas queue untuk backpressure: publish menunggu jika consumer tertinggal jauh
+QUEUE_MAXSIZE = CONSUMER_BATCH_SIZE * CONSUMER_WORKERS * 4
+
+# --- Konfigurasi Server ---
+# Lebih lama dari jeda polling maksimum publisher (5 detik) agar koneksi
+# keep-alive /stats tidak ditutup server di antara dua polling
+KEEP_ALIVE_TIMEOUT = 30
+
+# --- Helper ETag ---
+def make_etag(*parts) -> str:
+    """Membuat weak ETag dari state yang menentukan isi response."""
+    digest = hashlib.blake2b(":".join(map(str, parts)).encode(), digest_size=8).hexdigest()
+    return f'W/"{digest}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Cek apakah header If-None-Match dari client cocok dengan ETag saat ini."""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    candidates = {tag.strip() for tag in if_none_match.split(",")}
+    return "*" in candidates or etag in candidates
+
+# --- Helper Content-Type ---
+def is_json_content_type(request: Request) -> bool:
+    """
+    Cek Content-Type request adalah JSON (application/json atau */*+json),
+    sama seperti aturan FastAPI sebelum mem-parse body sebagai JSON.
+    Tanpa header Content-Type dianggap bukan JSON (strict_content_type bawaan).
+    """
+    content_type = request.headers.get("content-type")
+    if not content_type:
+        return False
+    message = email.message.Message()
+    message["content-type"] = content_type
+    subtype = message.get_content_subtype()
+    return message.get_content_maintype() == "application" and (
+        subtype == "json" or subtype.endswith("+json")
+    )
+
+# --- Skema OpenAPI /publish ---
+# Body dibaca manual (bukan parameter Pydantic), jadi requestBody dideklarasikan
+# sendiri; $ref ke Event yang sudah terdaftar lewat response model /events
+PUBLISH_BODY_SCHEMA = TypeAdapter(Union[Event, List[Event]]).json_schema(
+    ref_template="#/components/schemas/{model}"
+)
+PUBLISH_BODY_SCHEMA.pop("$defs", None)
+PUBLISH_OPENAPI_EXTRA = {
+    "requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": PUBLISH_BODY_SCHEMA}},
+    }
+}
 
 # Fungsi factory untuk testing
 def create_app() -> FastAPI:
     app = FastAPI(title="Idempotent Log Aggregator")
-    
-    # In-memory queue dan stats tracker
-    app.state.event_queue = asyncio.Queue()
-    app.state.stats_tracker = StatsTracker()
 
     @app.on_event("startup")
     async def startup_event():
         """Saat startup: inisialisasi DB dan jalankan consumer task(s)."""
+        # In-memory queue dan stats tracker dibuat per siklus hidup (lifespan),
+        # sehingga shutdown -> startup pada app yang sama setara dengan restart
+        app.state.event_queue = asyncio.Queue(maxsize=QUEUE_MAXSIZE)
+        app.state.stats_tracker = StatsTracker()
+        
         await database.init_db()
         
+        # Isi counter per topic dari DB sekali; selanjutnya di-update oleh consumer
+        app.state.stats_tracker.inc_topics(await database.get_topic_stats())
+        
+        # Koneksi baca untuk endpoint API dibuka sekali dan ditahan (seperti
+        # koneksi consumer), bukan dibuka ulang di setiap request /events
+        app.state.db_reader = await database.connect()
+        await database.configure_connection(app.state.db_reader)
+        
         # Buat task background untuk consumer
         app.state.consumer_tasks = []
         for i in range(CONSUMER_WORKERS):
@@ -51,6 +121,7 @@ def create_app() -> FastAPI:
             task.cancel()
         
         await asyncio.gather(*app.state.consumer_tasks, return_exceptions=True)
+        await app.state.db_reader.close()
         logging.info("Application shutdown complete.")
 
     # ===================================================================
@@ -61,9 +132,55 @@ def create_app() -> FastAPI:
         logging.info(f"[{worker_id}] Batch consumer task started...")
         
         # Buka koneksi DB sekali per worker dan tahan
-        async with aiosqlite.connect(database.DATABASE_PATH) as db:
+        async with database.connect() as db:
+            await database.configure_connection(db)
+            # Satu cursor dipakai ulang untuk semua batch (tanpa alokasi cursor per
+            # batch). Reuse statement INSERT yang sudah di-prepare tidak bergantung
+            # pada cursor: statement cache sqlite3 milik koneksi dan di-key dengan
+            # teks SQL, yang tetap sedikit karena ukuran chunk INSERT dibatasi
+            # (lihat database.INSERT_CHUNK_SIZES)
+            cursor = await db.cursor()
             logging.info(f"[{worker_id}] Consumer connected to DB.")
             
+            # State transaksi yang belum di-commit (group commit lintas batch)
+            pending_rows = 0
+            pending_topics = Counter()
+            tx_start = 0.0
+
+            async def commit_pending():
+                """Commit transaksi terbuka, lalu update stats & tandai event 'done'."""
+                nonlocal pending_rows, pending_topics
+                if pending_rows == 0:
+                    return
+                
+                try:
+                    await db.commit()
+                except aiosqlite.Error as e:
+                    logging.error(f"[{worker_id}] Error committing transaction: {e}", exc_info=True)
+                    pending_topics.clear() # Asumsikan gagal memproses
+                    try:
+                        await db.rollback()
+                    except aiosqlite.Error:
+                        pass
+                
+                new_count = sum(pending_topics.values())
+                duplicate_count = pending_rows - new_count
+                stats.inc_unique(new_count)
+                stats.inc_duplicate(duplicate_count)
+                stats.inc_topics(pending_topics)
+                
+                # Tandai semua task di queue sebagai 'done' setelah data durable
+                for _ in range(pending_rows):
+                    queue.task_done()
+                
+                logging.info(
+                    f"[{worker_id}] Committed {pending_rows} event(s). "
+                    f"New: {new_count}, Duplicates: {duplicate_count}. "
+                    f"Tx time: {(time.monotonic() - tx_start)*1000:.2f}ms"
+                )
+                pending_rows = 0
+                pending_topics = Counter()
+            
             while True:
                 batch = []
                 try:
@@ -73,48 +190,56 @@ def create_app() -> FastAPI:
                     
                     # 2. Kumpulkan event lain (jika ada) tanpa menunggu
                     # Tujuannya untuk mengosongkan queue secepat mungkin
-                    while len(batch) < CONSUMER_BATCH_SIZE and not queue.empty():
+                    take = min(CONSUMER_BATCH_SIZE - 1, queue.qsize())
+                    for _ in range(take):
                         batch.append(queue.get_nowait())
                         
                 except asyncio.QueueEmpty:
                     pass
                 except asyncio.CancelledError:
                     logging.info(f"[{worker_id}] Consumer task stopping.")
+                    await commit_pending()
                     break # Keluar dari loop utama
                 except Exception as e:
                     logging.error(f"[{worker_id}] Error getting from queue: {e}", exc_info=True)
                     continue # Coba lagi
 
-                # 3. Proses batch yang sudah terkumpul
+                # 3. Proses batch yang sudah terkumpul (di dalam transaksi terbuka)
                 if batch:
                     try:
                         start_batch_time = time.monotonic()
+                        if pending_rows == 0:
+                            tx_start = start_batch_time
                         
-                        # Panggil fungsi database BATCH
-                        new_count = await database.batch_mark_events_processed(db, batch)
+                        # Panggil fungsi database BATCH (tanpa commit)
+                        new_per_topic = await database.batch_mark_events_processed(cursor, batch)
+                        new_count = sum(new_per_topic.values())
+                        pending_rows += len(batch)
+                        pending_topics.update(new_per_topic)
                         
                         end_batch_time = time.monotonic()
                         
-                        duplicate_count = len(batch) - new_count
-                        
-                        # Update stats (ini thread-safe)
-                        stats.inc_unique(new_count)
-                        stats.inc_duplicate(duplicate_count)
-                        
-                        # Tandai semua task di queue sebagai 'done'
-                        for _ in batch:
-                            queue.task_done()
-                        
                         logging.info(
                             f"[{worker_id}] Processed batch of {len(batch)}. "
-                            f"New: {new_count}, Duplicates: {duplicate_count}. "
+                            f"New: {new_count}, Duplicates: {len(batch) - new_count}. "
                             f"Time: {(end_batch_time - start_batch_time)*1000:.2f}ms"
                         )
+                        
+                        # 4. Group commit: satu fsync untuk beberapa batch. Commit saat
+                        # budget baris/waktu habis, atau saat queue kosong (tidak ada
+                        # batch lain yang bisa digabung).
+                        if (
+                            pending_rows >= GROUP_COMMIT_ROWS
+                            or end_batch_time - tx_start >= GROUP_COMMIT_INTERVAL
+                            or queue.empty()
+                        ):
+                            await commit_pending()
                     
                     except aiosqlite.Error as e:
                         logging.error(f"[{worker_id}] Error processing batch: {e}", exc_info=True)
                     except asyncio.CancelledError:
                         logging.info(f"[{worker_id}] Consumer task stopping during batch process.")
+                        await commit_pending()
                         break
                     except Exception as e:
                         logging.error(f"[{worker_id}] Unexpected error in consumer loop: {e}", exc_info=True)
@@ -124,43 +249,96 @@ def create_app() -> FastAPI:
 
     # --- API Endpoints ---
 
-    @app.post("/publish")
-    async def publish_events(
-        events: Union[Event, List[Event]], 
-        request: Request
-    ):
+    @app.post("/publish", openapi_extra=PUBLISH_OPENAPI_EXTRA)
+    async def publish_events(request: Request):
         """
         Menerima satu atau batch event dan menambahkannya ke queue.
+        Body divalidasi langsung dengan TypeAdapter agar batch divalidasi
+        sekali jalan, bukan per item lewat Union.
         """
         queue = request.app.state.event_queue
         stats = request.app.state.stats_tracker
         
-        event_list = [events] if isinstance(events, Event) else events
+        if not is_json_content_type(request):
+            raise RequestValidationError(
+                [{"type": "content_type", "loc": ("body",), "msg": "Content-Type must be application/json", "input": None}]
+            )
+        
+        try:
+            body = await request.json()
+        except ValueError:
+            raise RequestValidationError(
+                [{"type": "json_invalid", "loc": ("body",), "msg": "JSON decode error", "input": {}}]
+            )
         
+        try:
+            if isinstance(body, dict):
+                event_list = [Event.model_validate(body)]
+            else:
+                event_list = EventListAdapter.validate_python(body)
+        except ValidationError as e:
+            # Prefix 'body' seperti validasi bawaan FastAPI
+            raise RequestValidationError(
+                [{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)]
+            )
+        
+        # put_nowait menghindari context switch per event; fallback ke
+        # 'await put' hanya saat queue penuh (backpressure)
         for event in event_list:
-            await queue.put(event)
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                await queue.put(event)
         
         stats.inc_received(len(event_list))
         return {"status": "queued", "received_count": len(event_list)}
 
-    @app.get("/events", response_model=List[Event])
-    async def get_processed_events(topic: str = Query(..., min_length=1)):
+    @app.get("/events", response_class=Response, responses={200: {"model": List[Event]}})
+    async def get_processed_events(
+        request: Request,
+        topic: str = Query(..., min_length=1),
+    ):
         """Mengembalikan daftar event unik yang telah diproses untuk topic tertentu."""
-        events = await database.get_events_by_topic(topic)
-        # Pydantic akan memvalidasi ulang output
-        return events
+        # Tabel hanya di-INSERT, jadi jumlah event per topic menentukan isinya
+        stats_tracker = request.app.state.stats_tracker
+        topic_count = stats_tracker.topics.get(topic, 0)
+        # start_ns membedakan siklus hidup proses, agar ETag lama tidak cocok setelah restart
+        etag = make_etag(stats_tracker.start_ns, topic, topic_count)
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        
+        events = await database.get_events_by_topic(topic, request.app.state.db_reader)
+        if events is None:
+            # Baca gagal: jangan kirim list kosong ber-ETag yang bisa di-revalidate (304)
+            raise HTTPException(status_code=503, detail="Gagal membaca events dari database")
+        # Data berasal dari DB yang hanya kita tulis, jadi tidak perlu validasi
+        # ulang lewat Pydantic; langsung di-encode dengan orjson (fallback json
+        # stdlib untuk nilai yang tidak didukung orjson, mis. integer > 64-bit)
+        return Response(
+            content=database.dumps_json(events),
+            media_type="application/json",
+            headers={"ETag": etag},
+        )
 
     @app.get("/stats")
-    async def get_aggregator_stats(request: Request):
+    async def get_aggregator_stats(request: Request, response: Response):
         """Menampilkan statistik operasional."""
         stats_tracker = request.app.state.stats_tracker
-        current_stats = stats_tracker.get_stats()
-        
-        # Ambil jumlah unik per topic dari DB
-        topic_stats = await database.get_topic_stats()
-        current_stats["topics"] = topic_stats
+        # Counter di-reset saat restart sementara topics diisi ulang dari DB,
+        # jadi start_ns ikut di ETag agar tidak ada 304 yang basi
+        etag = make_etag(
+            stats_tracker.start_ns,
+            stats_tracker.received,
+            stats_tracker.unique_processed,
+            stats_tracker.duplicate_dropped,
+        )
+        # State belum berubah sejak polling terakhir: lewati serialisasi body
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag})
         
-        return current_stats
+        response.headers["ETag"] = etag
+        # Jumlah unik per topic sudah dilacak in-memory, tanpa query GROUP BY ke DB
+        return stats_tracker.get_stats()
 
     return app
 
@@ -169,4 +347,4 @@ app = create_app()
 
 if __name__ == "__main__":
     # Ini akan dieksekusi oleh CMD ["python", "-m", "src.main"]
-    uvicorn.run("src.main:app", host="0.0.0.0", port=8080)
\ No newline at end of file
+    uvicorn.run("src.main:app", host="0.0.0.0", port=8080, timeout_keep_alive=KEEP_ALIVE_TIMEOUT)
\ No newline at end of file
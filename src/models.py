@@ -1,6 +1,6 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter
 from datetime import datetime
-from typing import Dict, Any
+from typing import Dict, Any, List
 
 # Event JSON 
 class Event(BaseModel):
@@ -13,4 +13,7 @@ class Event(BaseModel):
     # Kunci unik untuk deduplikasi
     @property
     def unique_key(self) -> tuple:
-        return (self.topic, self.event_id)
\ No newline at end of file
+        return (self.topic, self.event_id)
+
+# Validator batch: memvalidasi seluruh list event dalam satu panggilan (core Rust)
+EventListAdapter = TypeAdapter(List[Event])
\ No newline at end of file
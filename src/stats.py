@@ -1,6 +1,7 @@
 # src/stats.py
 import time
 from dataclasses import dataclass, field
+from typing import Dict, Optional
 
 @dataclass
 class StatsTracker:
@@ -11,7 +12,20 @@ class StatsTracker:
     received: int = 0
     unique_processed: int = 0
     duplicate_dropped: int = 0
-    start_time: float = field(default_factory=time.monotonic)
+    start_ns: int = field(default_factory=time.monotonic_ns)
+    topics: Dict[str, int] = field(default_factory=dict)
+    # Cache bagian statistik yang hanya bergantung pada counter
+    _counts_key: Optional[tuple] = field(default=None, init=False, repr=False)
+    _counts_cache: dict = field(default_factory=dict, init=False, repr=False)
+
+    def reset(self):
+        """Mengembalikan semua counter ke nol (mis. saat data di DB dikosongkan)."""
+        self.received = 0
+        self.unique_processed = 0
+        self.duplicate_dropped = 0
+        self.start_ns = time.monotonic_ns()
+        self.topics.clear()
+        self._counts_key = None
 
     def inc_received(self, count: int = 1):
         """Menambah jumlah event yang diterima dari publisher."""
@@ -25,20 +39,40 @@ class StatsTracker:
         """Menambah jumlah event duplikat yang di-drop."""
         self.duplicate_dropped += count
 
+    def inc_topics(self, counts: Dict[str, int]):
+        """Menambah jumlah event unik per topic (tanpa perlu query ke DB)."""
+        for topic, count in counts.items():
+            self.topics[topic] = self.topics.get(topic, 0) + count
+        self._counts_key = None
+
+    def _count_stats(self) -> dict:
+        """
+        Statistik turunan counter, dihitung ulang hanya jika counter berubah
+        sejak pemanggilan terakhir (polling /stats yang rapat memakai cache).
+        """
+        key = (self.received, self.unique_processed, self.duplicate_dropped)
+        if key != self._counts_key:
+            self._counts_cache = {
+                "received": self.received,
+                "unique_processed": self.unique_processed,
+                "duplicate_dropped": self.duplicate_dropped,
+                "duplicate_rate": (
+                    round(self.duplicate_dropped / self.received, 4)
+                    if self.received > 0 else 0
+                ),
+                "topics": dict(self.topics),
+            }
+            self._counts_key = key
+        return self._counts_cache
+
     def get_stats(self) -> dict:
         """Mengembalikan statistik sistem dalam bentuk dictionary."""
-        uptime = time.monotonic() - self.start_time
+        uptime_ns = time.monotonic_ns() - self.start_ns
         return {
-            "received": self.received,
-            "unique_processed": self.unique_processed,
-            "duplicate_dropped": self.duplicate_dropped,
-            "uptime_seconds": round(uptime, 2),
+            **self._count_stats(),
+            "uptime_seconds": round(uptime_ns / 1e9, 2),
             "throughput": (
-                round(self.unique_processed / uptime, 4)
-                if uptime > 0 else 0
-            ),
-            "duplicate_rate": (
-                round(self.duplicate_dropped / self.received, 4)
-                if self.received > 0 else 0
+                round(self.unique_processed * 1e9 / uptime_ns, 4)
+                if uptime_ns > 0 else 0
             ),
-        }
\ No newline at end of file
+        }
@@ -5,162 +5,332 @@ import os
 import time
 import asyncio
 import httpx
+import json
+import math
+import orjson
+import uuid
+import aiosqlite
 from httpx import AsyncClient
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
+from typing import Optional
 
-# --- Fixtures ---
+# Nama worker pytest-xdist ("gw0", "gw1", ...) atau "master" tanpa xdist,
+# dipakai di nama DB agar aman dijalankan paralel dengan 'pytest -n auto'
+WORKER_ID = os.environ.get("PYTEST_XDIST_WORKER", "master")
+
+# URL endpoint dibangun sekali (parsing & encoding query tidak diulang per request)
+BASE_URL = "http://test"
+PUBLISH_URL = httpx.URL(f"{BASE_URL}/publish")
+STATS_URL = httpx.URL(f"{BASE_URL}/stats")
+EVENTS_LOGS = httpx.URL(f"{BASE_URL}/events", params={"topic": "logs"})
+EVENTS_TOPIC_B = httpx.URL(f"{BASE_URL}/events", params={"topic": "topic-b"})
+EVENTS_TOPIC_C = httpx.URL(f"{BASE_URL}/events", params={"topic": "topic-c"})
 
-@pytest.fixture(scope="session")
-def event_loop():
-    """Fixture untuk event loop asyncio."""
-    loop = asyncio.get_event_loop_policy().new_event_loop()
-    yield loop
-    loop.close()
+# Batas tunggu queue kosong; batch yang hilang (task_done tidak dipanggil)
+# menjadi error yang jelas, bukan tes yang menggantung
+DRAIN_TIMEOUT = 10
+
+# --- Fixtures ---
 
-@pytest_asyncio.fixture(scope="function")
-async def async_client(tmp_path):
+@pytest_asyncio.fixture(scope="module", loop_scope="module")
+async def memory_db():
     """
-    Fixture yang membuat app dan client baru untuk setiap tes.
-    Setiap tes akan menggunakan file database unik di direktori temporer.
+    Database SQLite in-memory (shared cache) untuk modul ini, agar commit tidak
+    menyentuh disk. Fixture menahan satu koneksi karena DB in-memory hilang saat
+    koneksi terakhir ditutup.
     """
-    # Buat path database unik untuk tes ini menggunakan tmp_path dari pytest
-    db_path = tmp_path / "test_aggregator.db"
-
-    # Ganti path DB di modul database
+    # Ganti path DB di modul database dengan URI in-memory yang unik untuk modul ini
     from src import database
-    database.DATABASE_PATH = str(db_path)
+    database.DATABASE_PATH = (
+        f"file:test_aggregator_{WORKER_ID}_{uuid.uuid4().hex}?mode=memory&cache=shared"
+    )
+
+    async with database.connect() as keeper:
+        yield keeper
 
+@pytest_asyncio.fixture(scope="module", loop_scope="module")
+async def app(memory_db):
+    """Fixture yang membuat app sekali per modul tes (lifespan tetap terbuka)."""
     # Import dan buat app
     from src.main import create_app
     app = create_app()
 
     # Gunakan Lifespan Context Manager untuk startup/shutdown yang andal
     async with app.router.lifespan_context(app):
-        # Buat client dan jalankan tes
-        transport = httpx.ASGITransport(app=app)
-        async with AsyncClient(transport=transport, base_url="http://test") as client:
-            yield client # Tes berjalan di sini
-    
-    # Tidak perlu menghapus file secara manual, tmp_path akan membersihkannya.
+        yield app
+
+@pytest_asyncio.fixture(scope="module", loop_scope="module")
+async def template_db(app, memory_db):
+    """
+    Snapshot DB tepat setelah skema dibuat oleh startup app ("template database").
+    Dipulihkan sebelum setiap tes dengan backup(), tanpa menjalankan ulang DDL.
+    """
+    async with aiosqlite.connect(":memory:") as template:
+        await memory_db.backup(template)
+        yield template
+
+@pytest_asyncio.fixture(loop_scope="module")
+async def file_app(tmp_path):
+    """
+    Fixture app (belum di-start) dengan database file di tmp_path, khusus tes
+    persistensi; tes menjalankan lifespan sendiri untuk mensimulasikan restart.
+    Yield (app, db_path) agar tes tidak perlu meminta tmp_path sendiri.
+    """
+    from src import database
+    from src.main import create_app
+
+    memory_path = database.DATABASE_PATH
+    db_path = tmp_path / f"test_aggregator_{WORKER_ID}.db"
+    database.DATABASE_PATH = str(db_path)
+    try:
+        yield create_app(), db_path
+    finally:
+        # Kembalikan path in-memory untuk tes lain di modul ini
+        database.DATABASE_PATH = memory_path
+
+@pytest_asyncio.fixture(scope="module", loop_scope="module")
+async def async_client(app):
+    """Fixture client yang dipakai bersama oleh semua tes di modul ini."""
+    transport = httpx.ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url=BASE_URL) as client:
+        yield client # Tes berjalan di sini
+
+@pytest_asyncio.fixture(autouse=True, loop_scope="module")
+async def reset_state(app, memory_db, template_db):
+    """
+    Mengisolasi state antar tes: tunggu consumer selesai, pulihkan DB dari
+    template, lalu reset stats tracker (tanpa membuat ulang app).
+    """
+    await drain(app)
+    await template_db.backup(memory_db)
+    app.state.stats_tracker.reset()
+    yield
 
 
 # ---- FUNGSI HELPER ----
-def create_event(event_id: str, topic="logs"):
+@asynccontextmanager
+async def running(app):
+    """Menjalankan lifespan app (startup -> shutdown) dan memberi client untuknya."""
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url=BASE_URL) as client:
+            yield client
+
+async def drain(app):
+    """Tunggu sampai consumer selesai memproses (dan commit) semua event di queue."""
+    try:
+        await asyncio.wait_for(app.state.event_queue.join(), timeout=DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        pytest.fail(
+            f"Queue belum selesai diproses setelah {DRAIN_TIMEOUT} detik; "
+            "consumer kemungkinan kehilangan batch (task_done tidak dipanggil)"
+        )
+
+JSON_HEADERS = {"content-type": "application/json"}
+
+async def publish(client: AsyncClient, body: bytes):
+    """POST /publish dengan body JSON yang sudah di-encode (bytes siap kirim)."""
+    return await client.post(PUBLISH_URL, content=body, headers=JSON_HEADERS)
+
+# Satu timestamp untuk semua event tes; teruskan 'ts' jika butuh waktu berbeda
+_FIXED_TS = datetime.now(timezone.utc).isoformat()
+
+def create_event(event_id: str, topic="logs", ts: Optional[str] = None):
     """Helper untuk membuat event."""
     return {
         "topic": topic,
         "event_id": event_id,
-        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "timestamp": ts or _FIXED_TS,
         "source": "test_publisher",
         "payload": {"message": f"Event {event_id}"}
     }
 
 # --- Tes API (Total 6 Tes) ---
 
-@pytest.mark.asyncio
-async def test_publish_single_event(async_client: AsyncClient):
-    """(1/6) Tes kirim satu event dan pastikan statusnya queued."""
-    event = create_event("e-1")
-    response = await async_client.post("/publish", json=event)
-    assert response.status_code == 200
-    assert response.json() == {"status": "queued", "received_count": 1}
+pytestmark = pytest.mark.asyncio(loop_scope="module")
 
+@pytest.mark.parametrize(
+    "body, expected_status, expected_body",
+    [
+        (orjson.dumps(create_event("e-1")), 200, {"status": "queued", "received_count": 1}),
+        (orjson.dumps([create_event("e-2"), create_event("e-3")]), 200, {"status": "queued", "received_count": 2}),
+        (orjson.dumps({"topic": "logs", "event_id": None}), 422, None), # event_id tidak valid
+        (b'{"topic": "logs",', 422, None), # JSON terpotong
+    ],
+    ids=["single", "batch", "invalid-schema", "malformed-json"],
+)
+async def test_publish(async_client: AsyncClient, body, expected_status, expected_body):
+    """
+    (1, 2/6) Tes kirim satu event dan batch dua event. Kasus skema salah di sini
+    hanya memastikan error validasi dipetakan ke 422; validasi skemanya sendiri
+    dites langsung di test_models.py (4/6).
+    """
+    response = await publish(async_client, body)
+    assert response.status_code == expected_status
+    if expected_body is not None:
+        assert response.json() == expected_body
+    if expected_status == 422:
+        # Lokasi error mengikuti format FastAPI: diawali "body"
+        assert all(err["loc"][0] == "body" for err in response.json()["detail"])
 
-@pytest.mark.asyncio
-async def test_publish_batch_events(async_client: AsyncClient):
-    """(2/6) Tes kirim batch dua event sekaligus."""
-    events = [create_event("e-2"), create_event("e-3")]
-    response = await async_client.post("/publish", json=events)
-    assert response.status_code == 200
-    assert response.json() == {"status": "queued", "received_count": 2}
+@pytest.mark.parametrize(
+    "headers",
+    [{"content-type": "text/plain"}, {}],
+    ids=["text-plain", "no-content-type"],
+)
+async def test_publish_rejects_non_json_content_type(async_client: AsyncClient, headers):
+    """Tes body JSON yang valid tetap ditolak (422) jika Content-Type bukan JSON."""
+    response = await async_client.post(
+        PUBLISH_URL, content=orjson.dumps(create_event("e-ct")), headers=headers
+    )
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["loc"] == ["body"]
 
-@pytest.mark.asyncio
-async def test_deduplication(async_client: AsyncClient):
+async def test_deduplication(app, async_client: AsyncClient):
     """(3/6) Tes agar event duplikat tidak disimpan dua kali."""
     event = create_event("e-duplicate", topic="logs")
-    r1 = await async_client.post("/publish", json=event)
-    r2 = await async_client.post("/publish", json=event)
+    # Event yang sama dikirim dua kali dalam satu batch; dedup terjadi di consumer
+    r1 = await publish(async_client, orjson.dumps([event, event]))
     assert r1.status_code == 200
-    assert r2.status_code == 200
+    assert r1.json()["received_count"] == 2
 
-    # Beri waktu consumer untuk memproses batch
-    await asyncio.sleep(0.3) 
+    # Tunggu consumer selesai memproses batch
+    await drain(app)
 
     # Ambil event di DB via endpoint /events
-    r3 = await async_client.get("/events?topic=logs") 
-    assert r3.status_code == 200
-    data = r3.json()
+    r2 = await async_client.get(EVENTS_LOGS)
+    assert r2.status_code == 200
+    data = r2.json()
 
     # Pastikan hanya 1 event dengan ID yang sama
     assert len(data) == 1
     assert data[0]["event_id"] == "e-duplicate"
 
-@pytest.mark.asyncio
-async def test_schema_validation_fail(async_client: AsyncClient):
-    """(4/6) Tes event dengan skema yang salah (cakupan: Validasi Skema)."""
-    bad_event = {"topic": "logs", "event_id": None} # event_id tidak valid
-    response = await async_client.post("/publish", json=bad_event)
-    assert response.status_code == 422 # Unprocessable Entity
+async def test_large_int_payload_not_dropped(app, async_client: AsyncClient):
+    """Tes payload dengan integer > 64-bit tetap tersimpan utuh bersama event lain di batch."""
+    events = [
+        create_event("ok-1"),
+        {**create_event("big-int"), "payload": {"n": 2**70}},
+        create_event("ok-2"),
+    ]
+    response = await publish(async_client, json.dumps(events).encode())
+    assert response.status_code == 200
+    await drain(app)
+
+    data = (await async_client.get(EVENTS_LOGS)).json()
+    assert sorted(d["event_id"] for d in data) == ["big-int", "ok-1", "ok-2"]
+    assert next(d for d in data if d["event_id"] == "big-int")["payload"] == {"n": 2**70}
+
+async def test_signed_zero_payload_kept(app, async_client: AsyncClient):
+    """Tes payload 0.0 dan -0.0 tidak tertukar (keduanya sama saat dibandingkan/di-hash)."""
+    events = [
+        {**create_event("neg-zero"), "payload": {"n": -0.0}},
+        {**create_event("pos-zero"), "payload": {"n": 0.0}},
+    ]
+    await publish(async_client, orjson.dumps(events))
+    await drain(app)
 
-@pytest.mark.asyncio
-async def test_get_events_endpoint_consistency(async_client: AsyncClient):
+    data = (await async_client.get(EVENTS_LOGS)).json()
+    signs = {d["event_id"]: math.copysign(1, d["payload"]["n"]) for d in data}
+    assert signs == {"neg-zero": -1, "pos-zero": 1}
+
+async def test_get_events_endpoint_consistency(app, async_client: AsyncClient):
     """(5/6) Tes konsistensi data di /events (cakupan: Konsistensi GET /events)."""
     event_1 = create_event("e-20", topic="topic-b")
     event_2 = create_event("e-20", topic="topic-c") # ID sama, topic beda (unik)
 
-    await async_client.post("/publish", json=[event_1, event_2])
-    await asyncio.sleep(0.3)
+    await publish(async_client, orjson.dumps([event_1, event_2]))
+    await drain(app)
+
+    # Kedua GET independen, jadi dijalankan bersamaan
+    responses = await asyncio.gather(
+        async_client.get(EVENTS_TOPIC_B),
+        async_client.get(EVENTS_TOPIC_C),
+    )
+    data = [r.json() for r in responses]
+
+    # Cek topic-b dan topic-c sekaligus: masing-masing tepat 1 event "e-20"
+    assert [r.status_code for r in responses] == [200, 200]
+    assert [len(d) for d in data] == [1, 1]
+    assert [d[0]["event_id"] for d in data] == ["e-20", "e-20"]
+    assert [d[0]["topic"] for d in data] == ["topic-b", "topic-c"]
+    # Timestamp UTC dikembalikan dengan akhiran "Z" (format Pydantic)
+    assert [d[0]["timestamp"] for d in data] == [_FIXED_TS.replace("+00:00", "Z")] * 2
+
+async def test_etag_conditional_get(app, async_client: AsyncClient):
+    """Tes If-None-Match: 304 selama data belum berubah, 200 setelah ada event baru."""
+    urls = (STATS_URL, EVENTS_LOGS)
+    etags = [(await async_client.get(url)).headers["etag"] for url in urls]
+
+    responses = [
+        await async_client.get(url, headers={"if-none-match": etag})
+        for url, etag in zip(urls, etags)
+    ]
+    assert [r.status_code for r in responses] == [304, 304]
+
+    await publish(async_client, orjson.dumps(create_event("e-etag")))
+    await drain(app)
 
-    # Cek topic-b
-    response_b = await async_client.get("/events?topic=topic-b")
-    assert response_b.status_code == 200
-    assert len(response_b.json()) == 1
-    assert response_b.json()[0]["event_id"] == "e-20"
+    responses = [
+        await async_client.get(url, headers={"if-none-match": etag})
+        for url, etag in zip(urls, etags)
+    ]
+    assert [r.status_code for r in responses] == [200, 200]
+    assert all(r.headers["etag"] != etag for r, etag in zip(responses, etags))
 
-    # Cek topic-c
-    response_c = await async_client.get("/events?topic=topic-c")
-    assert response_c.status_code == 200
-    assert len(response_c.json()) == 1
-    assert response_c.json()[0]["event_id"] == "e-20"
+async def test_events_read_failure_has_no_etag(app, async_client: AsyncClient, monkeypatch):
+    """Tes baca DB yang gagal tidak dijawab '200 []' ber-ETag (bisa di-cache sebagai 304)."""
+    def locked(*args, **kwargs):
+        raise aiosqlite.OperationalError("database is locked")
+    monkeypatch.setattr(app.state.db_reader, "execute", locked)
 
-@pytest.mark.asyncio
-async def test_persistence_on_restart(async_client: AsyncClient, tmp_path):
+    response = await async_client.get(EVENTS_LOGS)
+    assert response.status_code == 503
+    assert "etag" not in response.headers
+
+async def test_persistence_on_restart(file_app):
     """(6/6) Tes simulasi restart untuk memastikan persistensi (cakupan: Persistensi)."""
-    # Dapatkan path DB yang digunakan oleh fixture pertama
-    db_path = tmp_path / "test_aggregator.db"
-    
+    app, db_path = file_app
+    # Body di-encode sekali, dikirim ulang apa adanya setelah restart
+    event_persist = orjson.dumps(create_event("e-persist-1"))
+
     # --- Sesi Aplikasi Pertama ---
-    event_persist = create_event("e-persist-1")
-    await async_client.post("/publish", json=event_persist)
-    await asyncio.sleep(0.1)
+    async with running(app) as client:
+        await publish(client, event_persist)
+        await drain(app)
 
-    stats_1 = await async_client.get("/stats")
-    assert stats_1.json()["unique_processed"] == 1
+        stats_1 = await client.get(STATS_URL)
+        assert stats_1.json()["unique_processed"] == 1
 
-    # --- Sesi Aplikasi Kedua (Simulasi Restart) ---
-    # Kita akan membuat app baru yang menunjuk ke file DB yang SAMA
-    from src import database
-    database.DATABASE_PATH = str(db_path) # Pastikan menunjuk ke file yang sama
-    from src.main import create_app
+        # init_db harus menyalakan WAL agar commit consumer tidak memblokir /events
+        async with aiosqlite.connect(db_path) as db:
+            async with db.execute("PRAGMA journal_mode") as cursor:
+                assert (await cursor.fetchone())[0] == "wal"
 
-    app2 = create_app()
-    async with app2.router.lifespan_context(app2):
-        transport2 = httpx.ASGITransport(app=app2)
-        async with AsyncClient(transport=transport2, base_url="http://test") as client2:
-            # Kirim event yang SAMA lagi
-            await client2.post("/publish", json=event_persist)
-            await asyncio.sleep(0.3)
+    # --- Sesi Aplikasi Kedua (Simulasi Restart) ---
+    # App yang SAMA di-shutdown lalu di-startup ulang: queue & stats in-memory
+    # dibuat ulang, sementara data dedup dibaca kembali dari file DB yang SAMA
+    async with running(app) as client2:
+        # Kirim event yang SAMA lagi
+        await publish(client2, event_persist)
+        await drain(app)
 
-            # Cek stats di app KEDUA
-            stats_2 = await client2.get("/stats")
-            stats_data = stats_2.json()
+        # Ambil stats dan events di app KEDUA secara bersamaan
+        stats_2, events = await asyncio.gather(
+            client2.get(STATS_URL),
+            client2.get(EVENTS_LOGS),
+        )
 
-            # Diterima 1 (di app baru), tapi 0 unik diproses, 1 duplikat
-            assert stats_data["received"] == 1
-            assert stats_data["unique_processed"] == 0
-            assert stats_data["duplicate_dropped"] == 1
+        # Cek stats di app KEDUA
+        stats_data = stats_2.json()
 
-            # Cek DB (via endpoint) untuk memastikan hanya ada 1 total
-            events = await client2.get("/events?topic=logs")
-            assert len(events.json()) == 1
+        # Diterima 1 (setelah restart), tapi 0 unik diproses, 1 duplikat
+        assert stats_data["received"] == 1
+        assert stats_data["unique_processed"] == 0
+        assert stats_data["duplicate_dropped"] == 1
+        # Counter per topic diisi ulang dari DB saat startup
+        assert stats_data["topics"] == {"logs": 1}
 
+        # Cek DB (via endpoint) untuk memastikan hanya ada 1 total
+        assert len(events.json()) == 1
@@ -0,0 +1,17 @@
+# tests/test_models.py
+import pytest
+from pydantic import ValidationError
+
+from src.models import Event, EventListAdapter
+
+# --- Tes Validasi Skema (tanpa app, tanpa DB) ---
+
+def test_schema_validation_fail():
+    """(4/6) Tes event dengan skema yang salah (cakupan: Validasi Skema)."""
+    bad_event = {"topic": "logs", "event_id": None} # event_id tidak valid
+    with pytest.raises(ValidationError):
+        Event.model_validate(bad_event)
+
+    # Jalur batch /publish memakai EventListAdapter
+    with pytest.raises(ValidationError):
+        EventListAdapter.validate_python([bad_event])